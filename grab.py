@@ -1,53 +1,71 @@
 import streamlit as st
-import google.generativeai as genai
-from openai import OpenAI
+import diskcache
+from aiolimiter import AsyncLimiter
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_random_exponential
 import os
+import gc
+import logging
 import time
-import tempfile
+import io
+import re
+import difflib
+import functools
+import json
+import asyncio
+import concurrent.futures
+import contextlib
+import contextvars
+import queue
+import hashlib
+import threading
+from collections import OrderedDict
 
-# --- Page Configuration ---
-st.set_page_config(
-    page_title="Persian Lyrics Diacritics Studio",
-    page_icon="✒️",
-    layout="wide",
-    initial_sidebar_state="expanded"
-)
-
-# --- Custom CSS for RTL and Styling ---
-st.markdown("""
+# --- Static Page Content ---
+# Re-emitted on every rerun: Streamlit drops elements a run doesn't output, so a
+# once-per-session guard would lose the styles after the first interaction.
+_CSS = """
 <style>
+    /* Results are rendered once with st.code (which brings its own copy button) inside
+       keyed containers; these rules restyle those code blocks. */
+    .st-key-persian_output pre, .st-key-finglish_output pre {
+        padding: 25px !important;
+        border-radius: 10px;
+        margin-bottom: 20px;
+        box-shadow: 0 4px 6px rgba(0,0,0,0.1);
+        /* Let the browser skip layout/paint for long lyrics that are off-screen */
+        contain: content;
+        content-visibility: auto;
+        contain-intrinsic-size: auto 300px;
+    }
+    .st-key-persian_output code, .st-key-finglish_output code {
+        white-space: pre-wrap !important; /* Preserve newlines */
+        color: #000000 !important; /* Force black text for maximum contrast */
+    }
+
     /* Force RTL for Persian text areas */
-    .rtl-text {
+    .st-key-persian_output pre {
         direction: rtl;
         text-align: right;
-        font-family: 'Tahoma', 'Arial', sans-serif;
-        font-size: 1.6em;
-        line-height: 2.5em;
-        white-space: pre-wrap; /* Preserve newlines */
         background-color: #fefae0 !important; /* Force parchment color */
-        color: #000000 !important; /* Force black text for maximum contrast */
-        padding: 25px;
-        border-radius: 10px;
         border: 2px solid #d4a373 !important; /* Distinct border */
-        margin-bottom: 20px;
-        box-shadow: 0 4px 6px rgba(0,0,0,0.1);
+    }
+    .st-key-persian_output code {
+        font-family: 'Tahoma', 'Arial', sans-serif !important;
+        font-size: 1.6em !important;
+        line-height: 2.5em !important;
     }
     
     /* LTR Text for Finglish */
-    .ltr-text {
+    .st-key-finglish_output pre {
         direction: ltr;
         text-align: left;
-        font-family: 'Courier New', monospace;
-        font-size: 1.4em;
-        line-height: 2.0em;
-        white-space: pre-wrap;
         background-color: #f0f4f8 !important; /* Light blue-grey */
-        color: #000000 !important;
-        padding: 25px;
-        border-radius: 10px;
         border: 2px solid #6c757d !important;
-        margin-bottom: 20px;
-        box-shadow: 0 4px 6px rgba(0,0,0,0.1);
+    }
+    .st-key-finglish_output code {
+        font-family: 'Courier New', monospace !important;
+        font-size: 1.4em !important;
+        line-height: 2.0em !important;
     }
 
     .stTextArea textarea {
@@ -55,15 +73,236 @@ st.markdown("""
         font-family: 'Tahoma', 'Arial', sans-serif;
     }
 </style>
-""", unsafe_allow_html=True)
+"""
+
+_HOW_TO_USE = """
+    **How to use:**
+    1. **Upload Music** to extract lyrics OR enter text manually.
+    2. Click 'Generate Outputs'.
+    3. **Left:** Get Persian text with Diacritics.
+    4. **Right:** Get Finglish text for Suno AI.
+    5. **Bottom:** Use Voice Input to correct the text.
+    """
+
+# Shared by every prompt that writes diacritics (generate, voice correction, upload),
+# so the rules are built once and stay identical across calls.
+DIACRITIC_RULES = """
+    **Persian-Specific Diacritic Rules (CRITICAL - YOU MUST FOLLOW THESE):**
+       - **NEVER use Fatha (َ) before Aleph (ا).** This is the most important rule.
+         - **CORRECT:** 'را', 'ما', 'با', 'خانه', 'دانا', 'توانا'
+         - **WRONG:** 'رَا', 'مَا', 'بَا', 'خَانَه', 'دَانَا', 'تَوَانَا' -> **YOU MUST REMOVE THE FATHA**.
+       - **NEVER use Fatha (َ) before He (ه)** unless the sound is explicitly "ah" (like 'dah' or 'mah'). For the silent 'eh' ending (e.g., 'khaneh', 'nameh'), do NOT use Fatha.
+         - **CORRECT:** 'خانه', 'نامه', 'بنده'
+         - **WRONG:** 'خَانَه', 'نَامَه', 'بَندَه'
+       - **NEVER** use Sokoun (ْ) at all. It is not used in this style. **REMOVE** any existing Sokoun.
+       - **ONLY** use Damma (ُ) before Vav (و) if the sound is specifically "oo" (like 'ooo'). Do not use it for 'ow'.
+       - **NEVER** use Kasra (ِ) before Ye (ی) unless the sound is specifically "-ay". (e.g. Write 'ویرانه', not 'وِیرانه')
+       - Use standard **Persian-style** diacritics (Harakat) for modern poetry; focus on Fatha (َ), Kasra (ِ), and Damma (ُ) for pronunciation clarity.
+"""
+
+# --- Prompts ---
+# Static prompt bodies, built once per run instead of on every call. The text-only prompts
+# end with their input label, so callers just append the text.
+DIACRITICS_PROMPT = f"""
+    لطفا این شعر فارسی را برای پرامپ موزیک اعراب گذاری کن.
+    
+    Strict Rules:
+    1. **PRE-PROCESSING:** If the input text already contains diacritics, **REMOVE** or **CORRECT** them completely if they violate the rules below. Do not treat existing marks as correct.
+    2. Output ONLY the processed Persian text with diacritics.
+    3. Do not add translations, explanations, or introductory text.
+    {DIACRITIC_RULES}
+    Input Text:
+"""
+
+FINGLISH_PROMPT = """
+    Convert the following Persian lyrics into "Finglish" (Pinglish) specifically optimized for AI Music Generators like Suno AI.
+    
+    Strict Rules:
+    1. The output must be phonetically accurate so an English-based AI reads it as Persian.
+    2. Use clear spacing.
+    3. Output ONLY the Finglish text. No explanations.
+    4. Maintain the line structure of the original poem.
+    
+    Input Persian Text:
+"""
+
+EXTRACT_PROMPT = """
+    Listen to this audio file containing a Persian song.
+    
+    **AUDIO PROCESSING INSTRUCTION:** Focus strictly on the VOCAL track. Mentally separate the vocals from the background music, noise, and instrumentation. 
+    Transcribe only the clear lyrical content.
+    
+    Task: Transcribe the lyrics exactly as sung in Persian.
+    
+    Rules:
+    1. Output ONLY the Persian lyrics.
+    2. Do not add translation or transliteration.
+    3. Break lines according to the musical phrasing.
+    4. Ignore instrumental parts and background noise.
+    """
+
+EXTRACT_ALL_PROMPT = f"""
+    Listen to this audio file containing a Persian song.
+    
+    **AUDIO PROCESSING INSTRUCTION:** Focus strictly on the VOCAL track. Mentally separate the vocals from the background music, noise, and instrumentation. 
+    Transcribe only the clear lyrical content.
+    
+    Produce three versions of the lyrics and return them as a JSON object with exactly these keys:
+    - "lyrics": the Persian lyrics exactly as sung, without diacritics. Break lines according to the musical phrasing. Ignore instrumental parts and background noise. No translation or transliteration.
+    - "diacritics": the same lyrics with Persian-style diacritics (Harakat) added for music prompts, following the rules below.
+    - "finglish": the same lyrics in "Finglish" (Pinglish) optimized for AI Music Generators like Suno AI: phonetically accurate so an English-based AI reads it as Persian, clear spacing, same line structure.
+    
+    {DIACRITIC_RULES}
+    Output ONLY the JSON object. No explanations.
+    """
+
+CORRECTION_PHRASE_PROMPT = """
+    Listen to this short Persian recording. The speaker is reciting a word, phrase or line of song lyrics.
+    Output ONLY the Persian words you hear, on a single line, without diacritics, translation or explanation.
+    """
+
+# Filled in with str.format (the rules contain no braces)
+VOICE_CORRECTION_PROMPT = """
+    You are an expert Persian editor. 
+    The user (a native speaker) has provided an audio recording to correct a SPECIFIC PART of the "Target Line" below.
+    
+    Task:
+    1. Listen to the audio. The user is reciting a correction for a specific phrase in the Target Line.
+    2. Replace ONLY that specific segment with the corrected version from the audio. 
+    3. **DO NOT** change the rest of the line. Keep surrounding words exactly as is.
+    4. **STRIP** any bad existing marks in the target segment first, then apply the diacritic rules below.
+    5. Output ONLY the corrected Target Line, as a single line. The previous and next lines are context; do not output them.
+    
+""" + DIACRITIC_RULES + """
+    Previous Line:
+    {previous_line}
+    
+    Target Line:
+    {target_line}
+    
+    Next Line:
+    {next_line}
+    """
+
+# --- Page Configuration ---
+st.set_page_config(
+    page_title="Persian Lyrics Diacritics Studio",
+    page_icon="✒️",
+    layout="wide",
+    initial_sidebar_state="expanded"
+)
+
+# --- Custom CSS for RTL and Styling ---
+# The CSS is an argument (not a global read inside) so the cache key changes when _CSS is edited
+@st.cache_resource
+def minify_css(css):
+    """css without comments and indentation, computed once per process rather than per rerun."""
+    css = re.sub(r"/\*.*?\*/", "", css, flags=re.DOTALL)
+    css = re.sub(r"\s+", " ", css)
+    return re.sub(r"\s*([{};:,>])\s*", r"\1", css).strip()
+
+_MINIFIED_CSS = minify_css(_CSS)
+
+st.markdown(_MINIFIED_CSS, unsafe_allow_html=True)
 
 # --- Session State Initialization ---
-if "lyrics_raw" not in st.session_state:
-    st.session_state.lyrics_raw = ""
 if "lyrics_processed" not in st.session_state:
     st.session_state.lyrics_processed = ""
 if "lyrics_finglish" not in st.session_state:
     st.session_state.lyrics_finglish = ""
+if "lyrics_input" not in st.session_state:  # backs the lyrics text area
+    st.session_state.lyrics_input = ""
+if "pending_finglish" not in st.session_state:  # background Finglish update, see submit_async
+    st.session_state.pending_finglish = None
+if "finglish_notices" not in st.session_state:  # UI calls of a finished background update
+    st.session_state.finglish_notices = None
+
+def reset_session():
+    """Clears the stored lyrics so their memory can be reclaimed right away."""
+    st.session_state.lyrics_processed = ""
+    st.session_state.lyrics_finglish = ""
+    st.session_state.lyrics_input = ""
+    st.session_state.pending_finglish = None
+    st.session_state.finglish_notices = None
+    gc.collect()
+
+# --- LLM Result Cache ---
+# st.cache_data can't memoize the async generators (it would cache the coroutine),
+# so results are looked up explicitly in one store shared by all sessions.
+class LLMCache:
+    """
+    Thread-safe LRU cache with a per-entry TTL for generated text, optionally backed by a
+    diskcache.Cache so results survive restarts and redeploys (memory is checked first).
+    """
+    def __init__(self, max_entries=256, ttl=3600, disk=None, disk_ttl=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.disk = disk
+        self.disk_ttl = disk_ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                expires_at, value = item
+                if expires_at >= time.monotonic():
+                    self._data.move_to_end(key)
+                    return value
+                del self._data[key]
+        if self.disk is None:
+            return None
+        # diskcache does its own locking (it's safe across threads and processes)
+        value = self.disk.get(key)
+        if value is not None:
+            self._remember(key, value)
+        return value
+
+    def set(self, key, value):
+        self._remember(key, value)
+        if self.disk is not None:
+            self.disk.set(key, value, expire=self.disk_ttl)
+
+    def _remember(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+        if self.disk is not None:
+            self.disk.clear()
+
+_DISK_CACHE_DIR = ".gemini_cache"
+
+@st.cache_resource
+def get_llm_cache():
+    # Results only go stale when a prompt changes (the prompt text is in the key), so keep them for a day
+    # in memory and indefinitely on disk, where the least recently used are evicted past the size limit.
+    return LLMCache(
+        max_entries=256,
+        ttl=24 * 60 * 60,
+        disk=diskcache.Cache(
+            _DISK_CACHE_DIR,
+            size_limit=256 * 1024 * 1024,
+            eviction_policy="least-recently-used",
+        ),
+        disk_ttl=None,
+    )
+
+def cache_key(task, model_name, *parts):
+    """Stable digest of a task, the model and its inputs (str or bytes)."""
+    h = hashlib.blake2b(digest_size=16)
+    for part in (task, model_name, *parts):
+        h.update(part if isinstance(part, bytes) else str(part).encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+llm_cache = get_llm_cache()
 
 # --- Sidebar: Configuration ---
 with st.sidebar:
@@ -104,36 +343,272 @@ with st.sidebar:
     openai_model = st.selectbox("Fallback Model", ["gpt-5-nano", "gpt-5-mini", "gpt-4o-mini", "gpt-4o"])
 
     st.divider()
+
+    background_finglish = st.toggle(
+        "Update Finglish in background",
+        help="After a voice correction, show the new Persian text right away and fill in the Finglish when it's ready",
+    )
+
+    if st.button("🧹 Clear LLM Cache", use_container_width=True, help="Forget cached results and call the models again"):
+        llm_cache.clear()
+        st.toast("LLM cache cleared.")
+
+    if st.button("♻️ Reset Session", use_container_width=True, help="Clear the lyrics stored for this browser tab"):
+        reset_session()
+        st.toast("Session cleared.")
+
+    st.divider()
     
-    st.info("""
-    **How to use:**
-    1. **Upload Music** to extract lyrics OR enter text manually.
-    2. Click 'Generate Outputs'.
-    3. **Left:** Get Persian text with Diacritics.
-    4. **Right:** Get Finglish text for Suno AI.
-    5. **Bottom:** Use Voice Input to correct the text.
-    """)
+    st.info(_HOW_TO_USE)
 
 # --- API Initialization ---
+# Clients are built once per (key, model) and reused across reruns and sessions. They are
+# keyed on a digest of the API key; the key itself is passed as an unhashed _api_key.
+def key_digest(api_key):
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+
+@functools.lru_cache(maxsize=None)
+def _genai():
+    """
+    The google.generativeai module, imported on first use so the page renders (and asks
+    for a key) without loading grpc/protobuf first.
+    """
+    import google.generativeai as genai
+    return genai
+
+@st.cache_resource
+def get_gemini_clients(api_key_digest, _api_key):
+    """
+    A client manager of our own for one key. genai.configure() sets a single process-wide key,
+    so with it sessions using different keys would all call with whichever was set last.
+    Relies on private SDK internals (_ClientManager here, GenerativeModel._async_client in
+    get_gemini_model), checked against google-generativeai 0.8.6; see requirements.txt.
+    """
+    _genai()
+    from google.generativeai.client import _ClientManager
+    clients = _ClientManager()
+    clients.configure(api_key=_api_key)
+    return clients
+
+@st.cache_resource
+def get_gemini_model(api_key_digest, _api_key, model_name):
+    clients = get_gemini_clients(api_key_digest, _api_key)
+    gemini_model = _genai().GenerativeModel(model_name)
+
+    # grpc's async channel binds to the loop it's created on, so build the client on the shared one
+    async def make_client():
+        return clients.make_client("generative_async")
+
+    # Set before the first call, so the model never picks up the global default client
+    gemini_model._async_client = asyncio.run_coroutine_threadsafe(make_client(), get_event_loop()).result()
+    return gemini_model
+
+@st.cache_resource
+def get_async_openai(api_key_digest, _api_key):
+    # Imported here so sessions without an OpenAI key never load openai/httpx/pydantic.
+    from openai import AsyncOpenAI
+    import httpx
+
+    # A dedicated pool so parallel fallbacks (diacritics + Finglish) don't queue behind each other.
+    http_client = httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+        http2=True,
+        timeout=60,
+    )
+    return AsyncOpenAI(api_key=_api_key, http_client=http_client)
+
+@st.cache_resource
+def get_event_loop():
+    """
+    One long-lived event loop for all async SDK calls. Async clients are bound to the
+    loop they first ran on, so a fresh asyncio.run() per click would break cached clients.
+    """
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="llm-event-loop", daemon=True).start()
+    return loop
+
+@st.cache_resource
+def get_gemini_limiter(api_key_digest, rpm):
+    """
+    Token bucket shared by all sessions using one key (quotas are per key), so together they
+    stay under its per-minute limit. None (no throttling) without a configured rate.
+    """
+    if not rpm:
+        return None
+    return AsyncLimiter(rpm, 60)
+
 if api_key:
-    genai.configure(api_key=api_key)
-    model = genai.GenerativeModel(model_choice)
+    model = get_gemini_model(key_digest(api_key), api_key, model_choice)
 else:
     st.warning("Please enter your Gemini API Key in the sidebar to proceed.")
     st.stop()
 
+# The key's requests-per-minute limit, a deployment setting like the keys themselves
+if "GEMINI_RPM" in st.secrets:
+    gemini_rpm = float(st.secrets["GEMINI_RPM"])
+else:
+    gemini_rpm = float(os.getenv("GEMINI_RPM") or 0)
+gemini_limiter = get_gemini_limiter(key_digest(api_key), gemini_rpm)
+
 openai_client = None
 if openai_api_key:
-    openai_client = OpenAI(api_key=openai_api_key)
+    openai_client = get_async_openai(key_digest(openai_api_key), openai_api_key)
 
 # --- Helper Functions ---
 
+# Streamlit elements can only be created from the script thread. Work that runs elsewhere
+# (coroutines on the shared event loop) queues its Streamlit calls here instead, and the
+# script thread applies them while it waits in run_async.
+_ui_calls = contextvars.ContextVar("ui_calls", default=None)
+
+def ui_call(fn, *args, **kwargs):
+    """Calls a Streamlit function now, or hands it to the script thread while inside run_async."""
+    calls = _ui_calls.get()
+    if calls is None:
+        fn(*args, **kwargs)
+    else:
+        calls.put((fn, args, kwargs))
+
+def notify(level, message):
+    """Shows st.warning / st.error (via ui_call, so it's safe from the event loop)."""
+    ui_call(getattr(st, level), message)
+
+def submit_async(coro):
+    """
+    Starts a coroutine on the shared event loop without waiting for it. Returns the
+    concurrent future and the queue its UI calls collect in (see apply_ui_calls).
+    """
+    calls = queue.SimpleQueue()
+    # The current context (and with it the call queue) is copied into the loop's task.
+    token = _ui_calls.set(calls)
+    try:
+        future = asyncio.run_coroutine_threadsafe(coro, get_event_loop())
+    finally:
+        _ui_calls.reset(token)
+    return future, calls
+
+def apply_ui_calls(calls):
+    """Runs the Streamlit calls a coroutine queued so far (on the script thread)."""
+    while not calls.empty():
+        fn, args, kwargs = calls.get()
+        fn(*args, **kwargs)
+
+def run_async(coro):
+    """Runs a coroutine on the shared event loop, applying its queued UI calls until it finishes."""
+    future, calls = submit_async(coro)
+    while True:
+        finished = future.done()
+        apply_ui_calls(calls)
+        if finished:
+            return future.result()
+        concurrent.futures.wait([future], timeout=0.05)
+
+# File extension per audio MIME type, so OpenAI can detect the upload's format
+_MIME_SUFFIX = {
+    "audio/mpeg": ".mp3",
+    "audio/mp3": ".mp3",
+    "audio/mpeg3": ".mp3",
+    "audio/ogg": ".ogg",
+    "audio/webm": ".webm",
+    "audio/mp4": ".m4a",
+    "audio/m4a": ".m4a",
+    "audio/x-m4a": ".m4a",
+    "audio/flac": ".flac",
+    "audio/x-flac": ".flac",
+    "audio/wav": ".wav",
+    "audio/x-wav": ".wav",
+    "audio/wave": ".wav",
+    "audio/vnd.wave": ".wav",
+}
+
+def _suffix_for(mime_type):
+    """Maps a MIME type (parameters like ';codecs=...' ignored) to a file suffix, defaulting to .wav."""
+    return _MIME_SUFFIX.get(mime_type.lower().split(";")[0].strip(), ".wav")
+
+def audio_digest(audio_bytes):
+    """Digest identifying an audio clip; computed once per clip and used in every cache key."""
+    return hashlib.blake2b(audio_bytes, digest_size=16).hexdigest()
+
+log = logging.getLogger(__name__)
+
+# Keyed on the clip's digest (the leading underscore keeps Streamlit from hashing the bytes again).
+# cache_resource hands back the cached bytes themselves; cache_data would unpickle a copy per call.
+@st.cache_resource(show_spinner=False, max_entries=4)
+def compress_audio(audio_key, _audio_bytes, mime_type):
+    """
+    Re-encodes audio as 16 kHz mono Opus, which is plenty for vocals and a fraction of
+    an MP3/WAV upload. Needs pydub + ffmpeg (see packages.txt); without them (or if decoding
+    fails) the original bytes come back unchanged. Returns (audio_bytes, mime_type).
+    """
+    audio_bytes = _audio_bytes
+    try:
+        from pydub import AudioSegment
+    except ImportError:
+        log.warning("pydub isn't installed; sending audio uncompressed")
+        return audio_bytes, mime_type
+    try:
+        segment = AudioSegment.from_file(io.BytesIO(audio_bytes)).set_channels(1).set_frame_rate(16000)
+        buf = io.BytesIO()
+        segment.export(buf, format="ogg", codec="libopus", bitrate="24k")
+    except Exception:
+        # Most often ffmpeg missing from the system
+        log.warning("Couldn't compress %s audio; sending it uncompressed", mime_type, exc_info=True)
+        return audio_bytes, mime_type
+    compressed = buf.getvalue()
+    if len(compressed) >= len(audio_bytes):
+        return audio_bytes, mime_type
+    return compressed, "audio/ogg"
+
+# Gemini rejects requests over 20 MB and inline data is base64-encoded (+33%), so anything
+# bigger goes through the Files API instead.
+_INLINE_AUDIO_LIMIT = 15 * 1024 * 1024
+
+# Shared across reruns and sessions: one upload per clip and API key (files belong to the key
+# that uploaded them), kept a little under the 48 hours Gemini stores them for.
+@st.cache_resource(ttl=47 * 60 * 60, max_entries=32, show_spinner=False)
+def upload_audio(audio_key, api_key_digest, _api_key, mime_type, _audio_bytes):
+    """Uploads audio with the Files API (raw bytes, no base64) and waits until it's usable."""
+    # The key's own file client; genai.upload_file would use whichever key was configured last
+    file_client = get_gemini_clients(api_key_digest, _api_key).get_default_client("file")
+    File = _genai().types.File
+    audio_file = File(file_client.create_file(io.BytesIO(_audio_bytes), mime_type=mime_type))
+    deadline = time.monotonic() + 30
+    while audio_file.state.name == "PROCESSING" and time.monotonic() < deadline:
+        time.sleep(0.5)
+        audio_file = File(file_client.get_file(name=audio_file.name))
+    # Raising keeps a failed or unfinished upload out of the cache
+    if audio_file.state.name == "PROCESSING":
+        raise TimeoutError("Gemini was still processing the upload after 30 seconds")
+    if audio_file.state.name != "ACTIVE":
+        raise RuntimeError(f"Gemini couldn't process the upload (state {audio_file.state.name})")
+    return audio_file
+
+def audio_part(audio_bytes, mime_type, audio_key):
+    """
+    Request part for an audio clip. Large clips are uploaded once (see upload_audio) and
+    sent to Gemini as a file reference; the bytes stay in the part for the OpenAI fallback.
+    """
+    part = {"mime_type": mime_type, "data": audio_bytes}
+    if len(audio_bytes) <= _INLINE_AUDIO_LIMIT:
+        return part
+    try:
+        part["file"] = upload_audio(audio_key, key_digest(api_key), api_key, mime_type, audio_bytes)
+    except Exception as e:
+        st.warning(f"Audio upload failed, sending it inline instead: {e}")
+    return part
+
+def _gemini_parts(contents):
+    """Swaps uploaded audio parts for their file reference; Gemini doesn't need the bytes then."""
+    if not isinstance(contents, list):
+        return contents
+    return [item["file"] if isinstance(item, dict) and "file" in item else item for item in contents]
+
 class MockResponse:
     """Mock object to mimic Gemini response structure when using OpenAI."""
     def __init__(self, text):
         self.text = text
 
-def generate_with_openai_fallback(contents):
+async def generate_with_openai_fallback(contents):
     """Fallback function to generate text using OpenAI."""
     if not openai_client:
         return None
@@ -148,39 +623,23 @@ def generate_with_openai_fallback(contents):
                     prompt_parts.append(item)
                 elif isinstance(item, dict) and "data" in item:
                     # Handle Audio for OpenAI Fallback using GPT-4o Transcribe
-                    # We must save bytes to a temp file for the OpenAI library to read
+                    # The SDK accepts a (filename, file, mime) tuple, so the bytes never touch disk
                     try:
-                        # Improved MIME type mapping to ensure correct file extension
-                        suffix = ".wav" 
-                        if "mime_type" in item:
-                            mt = item["mime_type"].lower()
-                            if "mpeg" in mt or "mp3" in mt: suffix = ".mp3"
-                            elif "ogg" in mt: suffix = ".ogg"
-                            elif "webm" in mt: suffix = ".webm"
-                            elif "mp4" in mt or "m4a" in mt: suffix = ".m4a"
-                            elif "flac" in mt: suffix = ".flac"
-                            elif "wav" in mt: suffix = ".wav"
-
-                        with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp_file:
-                            tmp_file.write(item["data"])
-                            tmp_filepath = tmp_file.name
-                        
+                        suffix = _suffix_for(item.get("mime_type", ""))
+                        audio_file = ("audio" + suffix, io.BytesIO(item["data"]), item.get("mime_type", "audio/wav"))
+
                         # Transcribe audio using the superior gpt-4o-transcribe model
-                        with open(tmp_filepath, "rb") as audio_file:
-                            transcription = openai_client.audio.transcriptions.create(
-                                model="gpt-4o-transcribe", 
-                                file=audio_file,
-                                language="fa" # Hint for Persian
-                            )
+                        transcription = await openai_client.audio.transcriptions.create(
+                            model="gpt-4o-transcribe", 
+                            file=audio_file,
+                            language="fa" # Hint for Persian
+                        )
                         
                         # Add transcription to prompt
                         prompt_parts.append(f"\n[Audio Transcription]: {transcription.text}\n")
                         
-                        # Clean up temp file
-                        os.unlink(tmp_filepath)
-                        
                     except Exception as audio_err:
-                        st.warning(f"Fallback Audio Processing Error: {audio_err}")
+                        notify("warning", f"Fallback Audio Processing Error: {audio_err}")
                         
         else:
             prompt_parts.append(contents)
@@ -188,7 +647,7 @@ def generate_with_openai_fallback(contents):
         final_prompt = " ".join(prompt_parts)
 
         # Removed temperature=0.7 as reasoning models (like gpt-5-nano) often do not support it or require default (1)
-        response = openai_client.chat.completions.create(
+        response = await openai_client.chat.completions.create(
             model=openai_model,
             messages=[
                 {"role": "system", "content": "You are a helpful assistant specialized in Persian poetry and lyrics. You must strictly follow formatting rules."},
@@ -197,158 +656,299 @@ def generate_with_openai_fallback(contents):
         )
         return MockResponse(response.choices[0].message.content)
     except Exception as e:
-        st.error(f"⚠️ OpenAI Fallback Failed: {e}")
+        notify("error", f"⚠️ OpenAI Fallback Failed: {e}")
         return None
 
-def safe_generate_content(contents, **kwargs):
+_QUOTA_RE = re.compile(r"429|quota|resource|exhausted|limit", re.IGNORECASE)
+
+@functools.lru_cache(maxsize=256)
+def _is_quota(msg):
+    """Classifies an error message; memoized since quota storms repeat the same message."""
+    return bool(_QUOTA_RE.search(msg))
+
+def _is_quota_err(e):
+    """True for rate-limit / resource-exhausted errors, which are worth retrying or falling back on."""
+    return _is_quota(str(e))
+
+# Quota errors are retried with jittered backoff (so concurrent users don't retry in lockstep);
+# anything else fails fast. The last exception is re-raised for the fallback logic.
+_gemini_retry = retry(
+    wait=wait_random_exponential(multiplier=0.5, max=8),
+    stop=stop_after_attempt(3),
+    retry=retry_if_exception(_is_quota_err),
+    reraise=True,
+)
+
+@_gemini_retry
+async def _a_gemini_generate(contents, **kwargs):
+    # tenacity waits with asyncio.sleep here, so retries don't block the event loop.
+    # Each attempt (retries included) takes a token from the per-minute bucket, if there is one.
+    async with gemini_limiter or contextlib.nullcontext():
+        return await model.generate_content_async(contents, **kwargs)
+
+# Minimum new characters between placeholder updates while streaming; each update is a
+# full re-render of the slot, so tiny chunks are batched rather than drawn one by one.
+_STREAM_BATCH_CHARS = 40
+
+async def _a_stream_gemini(contents, on_text, **kwargs):
+    """Streams a Gemini response, passing the text received so far to on_text in batches."""
+    response = await _a_gemini_generate(contents, stream=True, **kwargs)
+    parts = []
+    pending = 0
+    async for chunk in response:
+        parts.append(chunk.text)
+        pending += len(chunk.text)
+        if pending >= _STREAM_BATCH_CHARS:
+            on_text("".join(parts))
+            pending = 0
+    if pending:
+        on_text("".join(parts))
+    return response
+
+async def a_safe_generate_content(contents, on_text=None, **kwargs):
     """
-    Wrapper for model.generate_content with exponential backoff and OpenAI fallback.
+    Wrapper for model.generate_content_async with jittered exponential backoff and OpenAI
+    fallback. With on_text, the Gemini response is streamed (the OpenAI fallback is not).
     """
-    retries = 2
-    delay = 1
-    last_exception = None
-
     # 1. Try Gemini with Retries
-    for attempt in range(retries):
-        try:
-            return model.generate_content(contents, **kwargs)
-        except Exception as e:
-            last_exception = e
-            error_str = str(e).lower()
-            # Catch wider range of resource/quota errors
-            if any(k in error_str for k in ["429", "quota", "resource", "exhausted", "limit"]):
-                time.sleep(delay)
-                delay *= 2
-            else:
-                # Break loop for non-quota errors to fail fast or try fallback
-                break
-    
-    # 2. If Gemini failed, try OpenAI Fallback
-    error_str = str(last_exception).lower() if last_exception else ""
-    # Broadened check for fallback trigger
-    if any(k in error_str for k in ["quota", "429", "resource", "exhausted", "limit"]):
+    try:
+        if on_text is None:
+            return await _a_gemini_generate(_gemini_parts(contents), **kwargs)
+        return await _a_stream_gemini(_gemini_parts(contents), on_text, **kwargs)
+    except Exception as e:
+        last_exception = e
+
+    # 2. If Gemini ran out of quota, try OpenAI Fallback
+    if _is_quota_err(last_exception):
         if openai_client:
-            st.warning(f"⚠️ Gemini Quota Exceeded. Switching to OpenAI ({openai_model}) for this request...")
-            fallback_response = generate_with_openai_fallback(contents)
+            notify("warning", f"⚠️ Gemini Quota Exceeded. Switching to OpenAI ({openai_model}) for this request...")
+            fallback_response = await generate_with_openai_fallback(contents)
             if fallback_response:
                 return fallback_response
         else:
-            st.error("⚠️ **Quota Exceeded:** Rate limit hit. Add OpenAI API Key for fallback.")
+            notify("error", "⚠️ **Quota Exceeded:** Rate limit hit. Add OpenAI API Key for fallback.")
             return None
-    
+
     # 3. Final Error Reporting
-    if last_exception:
-        st.error(f"⚠️ **API Error:** {last_exception}")
+    notify("error", f"⚠️ **API Error:** {last_exception}")
     return None
 
-def generate_diacritics(text):
-    """Calls Gemini (or fallback) to add diacritics to Persian text."""
-    prompt = f"""
-    لطفا این شعر فارسی را برای پرامپ موزیک اعراب گذاری کن.
-    
-    Strict Rules:
-    1. **PRE-PROCESSING:** If the input text already contains diacritics, **REMOVE** or **CORRECT** them completely if they violate the rules below. Do not treat existing marks as correct.
-    2. Output ONLY the processed Persian text with diacritics.
-    3. **Persian-Specific Rules (CRITICAL - YOU MUST FOLLOW THESE):**
-       - **NEVER use Fatha (َ) before Aleph (ا).** This is the most important rule.
-         - **CORRECT:** 'را', 'ما', 'با', 'خانه', 'دانا', 'توانا'
-         - **WRONG:** 'رَا', 'مَا', 'بَا', 'خَانَه', 'دَانَا', 'تَوَانَا' -> **YOU MUST REMOVE THE FATHA**.
-       - **NEVER use Fatha (َ) before He (ه)** unless the sound is explicitly "ah" (like 'dah' or 'mah'). For the silent 'eh' ending (e.g., 'khaneh', 'nameh'), do NOT use Fatha.
-         - **CORRECT:** 'خانه', 'نامه', 'بنده'
-         - **WRONG:** 'خَانَه', 'نَامَه', 'بَندَه'
-       - **NEVER** use Sokoun (ْ) at all. It is not used in this style. **REMOVE** any existing Sokoun.
-       - **ONLY** use Damma (ُ) before Vav (و) if the sound is specifically "oo" (like 'ooo'). Do not use it for 'ow'.
-       - **NEVER** use Kasra (ِ) before Ye (ی) unless the sound is specifically "-ay".
-    4. Use standard **Persian-style** diacritics (Harakat) for modern poetry.
-       - Focus on Fatha (َ), Kasra (ِ), and Damma (ُ) for pronunciation clarity.
-    5. Do not add translations, explanations, or introductory text.
-    
-    Input Text:
-    {text}
+async def a_generate_text(task, contents, *key_parts, on_text=None, **kwargs):
     """
-    response = safe_generate_content(prompt)
-    if response:
-        return response.text.strip()
+    a_safe_generate_content with result caching; on_text streams cache misses as they
+    arrive. Failures and OpenAI fallback answers are not cached. The key covers the text
+    parts of contents; key_parts stand in for the rest (e.g. an audio clip's digest).
+    """
+    # Keyed on the prompt text itself, so editing a prompt retires the results of the old one
+    prompt_parts = [contents] if isinstance(contents, str) else [p for p in contents if isinstance(p, str)]
+    key = cache_key(task, model_choice, *prompt_parts, *key_parts)
+    # The disk tier is sqlite (and LRU eviction makes every read a write too), so it runs in a
+    # worker thread instead of stalling every session's streaming on the shared loop
+    cached = await asyncio.to_thread(llm_cache.get, key)
+    if cached is not None:
+        return cached
+    response = await a_safe_generate_content(contents, on_text=on_text, **kwargs)
+    if not response:
+        return None
+    result = response.text.strip()
+    # A fallback answer isn't Gemini's (and may lack the audio), so it mustn't outlive the quota hit
+    if not isinstance(response, MockResponse):
+        await asyncio.to_thread(llm_cache.set, key, result)
+    return result
+
+def render_result(slot, text):
+    """Renders a result as plain text; the RTL/LTR look comes from the keyed container's CSS."""
+    slot.code(text, language=None, wrap_lines=True)
+
+def stream_to(slot):
+    """on_text callback that re-renders a placeholder (from the script thread), or None without one."""
+    if slot is None:
+        return None
+    return lambda text: ui_call(render_result, slot, text)
+
+async def a_generate_diacritics(text, slot=None):
+    """Calls Gemini (or fallback) to add diacritics to Persian text, streaming into slot if given."""
+    result = await a_generate_text("diacritics", DIACRITICS_PROMPT + text, on_text=stream_to(slot))
+    if result is not None:
+        return result
     return text
 
-def generate_finglish(text):
-    """Calls Gemini (or fallback) to create a Finglish version for Suno AI."""
-    prompt = f"""
-    Convert the following Persian lyrics into "Finglish" (Pinglish) specifically optimized for AI Music Generators like Suno AI.
-    
-    Strict Rules:
-    1. The output must be phonetically accurate so an English-based AI reads it as Persian.
-    2. Use clear spacing.
-    3. Output ONLY the Finglish text. No explanations.
-    4. Maintain the line structure of the original poem.
-    
-    Input Persian Text:
-    {text}
-    """
-    response = safe_generate_content(prompt)
-    if response:
-        return response.text.strip()
+async def a_generate_finglish(text, slot=None):
+    """Calls Gemini (or fallback) to create a Finglish version for Suno AI, streaming into slot if given."""
+    result = await a_generate_text("finglish", FINGLISH_PROMPT + text, on_text=stream_to(slot))
+    if result is not None:
+        return result
     return ""
 
-def extract_lyrics_from_audio(audio_bytes, mime_type):
-    """Extracts Persian lyrics from an uploaded audio file using AI vocal focus."""
-    prompt = """
-    Listen to this audio file containing a Persian song.
-    
-    **AUDIO PROCESSING INSTRUCTION:** Focus strictly on the VOCAL track. Mentally separate the vocals from the background music, noise, and instrumentation. 
-    Transcribe only the clear lyrical content.
-    
-    Task: Transcribe the lyrics exactly as sung in Persian.
-    
-    Rules:
-    1. Output ONLY the Persian lyrics.
-    2. Do not add translation or transliteration.
-    3. Break lines according to the musical phrasing.
-    4. Ignore instrumental parts and background noise.
+async def a_update_finglish(old_text, new_text, old_finglish):
     """
-    response = safe_generate_content([
-        prompt,
-        {
-            "mime_type": mime_type,
-            "data": audio_bytes
-        }
-    ])
-    if response:
-        return response.text.strip()
+    Brings old_finglish in line with an edited Persian text by re-transliterating only the
+    lines that changed. Falls back to a full transliteration when the line structure of
+    the three texts doesn't line up (or the partial answer has the wrong number of lines).
+    If a call fails, old_finglish is kept (with a warning) rather than blanked.
+    """
+    async def transliterate(text):
+        result = await a_generate_text("finglish", FINGLISH_PROMPT + text)
+        if result is None:
+            notify("warning", "⚠️ Finglish couldn't be updated, so it still follows the previous text.")
+        return result
+
+    old_lines = old_text.split("\n")
+    new_lines = new_text.split("\n")
+    finglish_lines = old_finglish.split("\n")
+    if not old_finglish or not (len(old_lines) == len(new_lines) == len(finglish_lines)):
+        return await transliterate(new_text) or old_finglish
+
+    changed = [i for i, (old, new) in enumerate(zip(old_lines, new_lines)) if old != new]
+    if not changed:
+        return old_finglish
+    result = await transliterate("\n".join(new_lines[i] for i in changed))
+    if result is None:
+        return old_finglish
+    result_lines = [line.strip() for line in result.split("\n") if line.strip()]
+    if len(result_lines) != len(changed):
+        return await transliterate(new_text) or old_finglish
+    for i, line in zip(changed, result_lines):
+        finglish_lines[i] = line
+    return "\n".join(finglish_lines)
+
+async def a_generate_both(text, persian_slot=None, finglish_slot=None):
+    """
+    Runs diacritics and Finglish generation concurrently; they share the input but nothing else.
+    An unexpected error in one is reported and replaced by its usual failure value
+    (the input text / "") instead of discarding the other's result.
+    """
+    results = await asyncio.gather(
+        a_generate_diacritics(text, persian_slot),
+        a_generate_finglish(text, finglish_slot),
+        return_exceptions=True,
+    )
+    outputs = []
+    for result, failed_value in zip(results, (text, "")):
+        if isinstance(result, BaseException):
+            notify("error", f"⚠️ **API Error:** {result}")
+            result = failed_value
+        outputs.append(result)
+    return tuple(outputs)
+
+async def a_extract_lyrics_from_audio(audio, audio_key):
+    """Extracts Persian lyrics from an uploaded audio file using AI vocal focus."""
+    result = await a_generate_text("extract", [
+        EXTRACT_PROMPT,
+        audio,
+    ], audio_key, audio["mime_type"])
+    if result is not None:
+        return result
     return ""
 
-def process_voice_correction(current_text, audio_bytes):
-    """Uses Gemini to correct text based on voice input."""
-    prompt = f"""
-    You are an expert Persian editor. 
-    The user (a native speaker) has provided an audio recording to correct a SPECIFIC PART of the lyrics below.
-    
-    Task:
-    1. Listen to the audio. The user is reciting a correction for a specific phrase or line.
-    2. Locate that specific phrase in the "Current Persian Text".
-    3. Replace ONLY that specific segment with the corrected version from the audio. 
-    4. **DO NOT** regenerate or change the rest of the text. Keep surrounding text exactly as is.
-    5. **CRITICAL Diacritic Rules:**
-       - **STRIP** any bad existing marks in the target segment first.
-       - **NEVER use Fatha (َ) before Aleph (ا).** (e.g. Write 'را' NOT 'رَا', Write 'ویرانه' NOT 'وِیرَانَه')
-       - **NEVER use Fatha (َ) before He (ه)** unless it sounds like "ah". For silent 'eh' (e.g. 'خانه'), do NOT use Fatha.
-       - **NEVER use Kasra (ِ) before Ye (ی)** for 'ee' sounds. (e.g. Write 'ویرانه', not 'وِیرانه')
-       - **NEVER** use Sokoun (ْ). Remove it if present.
-    6. Output the FULL text with the specific correction applied.
-    
-    Current Persian Text:
-    {current_text}
+_ALL_OUTPUT_KEYS = ("lyrics", "diacritics", "finglish")
+
+# Structured-output schema for the combined call, so Gemini can't drop or rename a key
+_ALL_OUTPUTS_SCHEMA = {
+    "type": "object",
+    "properties": {k: {"type": "string"} for k in _ALL_OUTPUT_KEYS},
+    "required": list(_ALL_OUTPUT_KEYS),
+}
+
+_FENCE_RE = re.compile(r"^```(?:json)?\s*|\s*```$")
+
+def _parse_all_outputs(raw):
+    """(lyrics, diacritics, finglish) from the combined JSON answer, or None if it isn't usable."""
+    try:
+        # The OpenAI fallback may wrap the JSON in a Markdown fence (```json or a bare ```)
+        data = json.loads(_FENCE_RE.sub("", raw.strip()))
+        outputs = tuple(data[k].strip() for k in _ALL_OUTPUT_KEYS)
+    except (AttributeError, TypeError, ValueError, KeyError):
+        return None
+    return outputs if outputs[0] else None
+
+async def a_extract_and_generate_all(audio, audio_key):
+    """
+    Transcribes a song and produces both the diacritized and the Finglish version in a
+    single Gemini call (JSON output) instead of three round-trips. If the answer can't be
+    parsed, falls back to a_extract_lyrics_from_audio + a_generate_both.
+    Returns (lyrics, diacritics, finglish), or None if no lyrics could be extracted.
     """
-    response = safe_generate_content([
+    result = await a_generate_text("extract_all", [
+        EXTRACT_ALL_PROMPT,
+        audio,
+    ], audio_key, audio["mime_type"], generation_config={
+        "response_mime_type": "application/json",
+        "response_schema": _ALL_OUTPUTS_SCHEMA,
+    })
+    if result is None:
+        # The API call itself failed (already reported); the separate calls would fail too
+        return None
+    outputs = _parse_all_outputs(result)
+    if outputs:
+        return outputs
+
+    lyrics = await a_extract_lyrics_from_audio(audio, audio_key)
+    if not lyrics:
+        return None
+    diacritics, finglish = await a_generate_both(lyrics)
+    return lyrics, diacritics, finglish
+
+# Harakat (Fatha, Kasra, Damma, Tanwin, Shadda, Sokoun) and superscript Aleph
+_HARAKAT_RE = re.compile("[\u064B-\u0652\u0670]")
+
+def strip_diacritics(text):
+    return _HARAKAT_RE.sub("", text)
+
+# Below this score the recording isn't taken to match any line, and the text is left alone
+_MIN_LINE_MATCH = 0.5
+
+def phrase_match(line, phrase):
+    """
+    How closely phrase (0-1) matches its best-fitting run of words in line. Scoring a window
+    the phrase's length, not the whole line, keeps a short phrase from favouring short lines.
+    """
+    words = line.split()
+    size = len(phrase.split())
+    windows = [" ".join(words[i:i + size]) for i in range(max(len(words) - size, 0) + 1)]
+    return max(difflib.SequenceMatcher(None, window, phrase).ratio() for window in windows)
+
+async def a_transcribe_correction(audio, audio_key):
+    """Transcribes the short correction the user recorded (no diacritics needed)."""
+    return await a_generate_text("correction_phrase", [
+        CORRECTION_PHRASE_PROMPT,
+        audio,
+    ], audio_key, audio["mime_type"])
+
+async def a_process_voice_correction(current_text, audio, audio_key):
+    """
+    Uses Gemini to correct text based on voice input. Only the line the recording
+    matches best (plus one line of context either side) is sent back to the model,
+    so the prompt stays a few lines long no matter how long the lyrics are. If no line
+    matches well enough, the text comes back unchanged.
+    """
+    lines = current_text.splitlines()
+    phrase = await a_transcribe_correction(audio, audio_key)
+    if not phrase or not any(line.strip() for line in lines):
+        return current_text
+
+    # Compare without diacritics: the transcription has none, the lyrics do
+    phrase_plain = strip_diacritics(phrase)
+    scores = [phrase_match(strip_diacritics(line), phrase_plain) for line in lines]
+    best = max(range(len(lines)), key=scores.__getitem__)
+    if scores[best] < _MIN_LINE_MATCH:
+        return current_text
+    previous_line = lines[best - 1] if best > 0 else ""
+    next_line = lines[best + 1] if best + 1 < len(lines) else ""
+
+    prompt = VOICE_CORRECTION_PROMPT.format(
+        previous_line=previous_line, target_line=lines[best], next_line=next_line
+    )
+    result = await a_generate_text("voice_correction", [
         prompt,
-        {
-            "mime_type": "audio/wav",
-            "data": audio_bytes
-        }
-    ])
-    if response:
-        return response.text.strip()
-    return current_text
+        audio,
+    ], audio_key, audio["mime_type"])
+    corrected = [line for line in (result or "").splitlines() if line.strip()]
+    if not corrected:
+        return current_text
+
+    lines[best] = corrected[0].strip()
+    return "\n".join(lines)
 
 # --- Main Layout ---
 st.subheader("📝 Persian Lyrics Input")
@@ -359,84 +959,144 @@ with st.expander("🎵 Extract Lyrics from Audio File"):
     if uploaded_file is not None:
         if st.button("Extract Lyrics (AI Vocal Focus) & Auto-Generate"):
             with st.spinner("Listening, transcribing, and processing..."):
-                audio_bytes = uploaded_file.read()
-                extracted_text = extract_lyrics_from_audio(audio_bytes, uploaded_file.type)
-                if extracted_text:
-                    st.session_state.lyrics_raw = extracted_text
-                    
-                    # Automatically generate outputs
-                    st.session_state.lyrics_processed = generate_diacritics(extracted_text)
-                    st.session_state.lyrics_finglish = generate_finglish(extracted_text)
-                    
+                # getvalue() hands back the upload buffer without the extra copy read() makes
+                audio_bytes = uploaded_file.getvalue()
+                # Hashed once here; the digest stands in for the bytes in every cache lookup
+                audio_key = audio_digest(audio_bytes)
+                # Shrunk to speech-quality Opus (and sent via the Files API if still large)
+                audio = audio_part(*compress_audio(audio_key, audio_bytes, uploaded_file.type), audio_key)
+                # Transcription, diacritics and Finglish come back from one call
+                outputs = run_async(a_extract_and_generate_all(audio, audio_key))
+                del audio_bytes, audio
+                if outputs:
+                    extracted_text, processed, finglish = outputs
+                    st.session_state.lyrics_input = extracted_text
+                    st.session_state.lyrics_processed = processed
+                    st.session_state.lyrics_finglish = finglish
+                    # No rerun: the text area and results below render from this state in the same pass
                     st.success("Lyrics extracted and processed! Check results below.")
-                    st.rerun()
-
-raw_input = st.text_area("Paste your lyrics here:", value=st.session_state.lyrics_raw, height=120, label_visibility="collapsed")
-
-if st.button("✨ Generate Outputs", type="primary", use_container_width=True):
-    if raw_input:
-        st.session_state.lyrics_raw = raw_input
-        with st.spinner("Processing Lyrics (Diacritics & Finglish)..."):
-            # Generate both concurrently (or sequentially for simplicity)
-            st.session_state.lyrics_processed = generate_diacritics(raw_input)
-            st.session_state.lyrics_finglish = generate_finglish(raw_input)
-            st.rerun()
-    else:
-        st.warning("Please enter some text first.")
+
+# A form, so typing or pasting doesn't rerun the script until the lyrics are submitted
+generate_requested = False
+with st.form("generate_form", border=False):
+    raw_input = st.text_area("Paste your lyrics here:", key="lyrics_input", height=120, label_visibility="collapsed")
+    if st.form_submit_button("✨ Generate Outputs", type="primary", use_container_width=True):
+        if raw_input:
+            generate_requested = True
+        else:
+            st.warning("Please enter some text first.")
+generate_status = st.container()
 
 st.divider()
 
+# Only polls while a background Finglish update is running
+@st.fragment(run_every=1 if st.session_state.pending_finglish else None)
+def pending_finglish_status():
+    """Shows a background Finglish update's progress and applies its result once it lands."""
+    pending = st.session_state.pending_finglish
+    if pending is None:
+        return
+    future, calls, persian = pending
+    if not future.done():
+        st.caption("⏳ Updating Finglish in the background...")
+        return
+    st.session_state.pending_finglish = None
+    try:
+        finglish = future.result()
+    except Exception as e:
+        calls.put((st.error, (f"⚠️ **API Error:** {e}",), {}))
+    else:
+        # Discard the result if the Persian text was regenerated or reset in the meantime
+        if persian == st.session_state.lyrics_processed:
+            st.session_state.lyrics_finglish = finglish
+    # Anything drawn in this fragment is gone after the rerun, so the update's notices are
+    # kept for the full run to show once
+    st.session_state.finglish_notices = calls
+    st.rerun(scope="app")
+
 col1, col2 = st.columns(2, gap="large")
 
 with col1:
     st.subheader("📖 Persian (اعراب گذاری)")
-    if st.session_state.lyrics_processed:
-        st.markdown(f"""
-        <div class='rtl-text'>{st.session_state.lyrics_processed}</div>
-        """, unsafe_allow_html=True)
-        
-        with st.expander("📋 Copy Persian / کپی متن"):
-            st.code(st.session_state.lyrics_processed, language="text")
-    else:
-        st.info("Persian result with diacritics will appear here.")
+    persian_slot = st.container(key="persian_output").empty()
 
 with col2:
     st.subheader("🎵 Finglish (Suno AI)")
-    if st.session_state.lyrics_finglish:
-        st.markdown(f"""
-        <div class='ltr-text'>{st.session_state.lyrics_finglish}</div>
-        """, unsafe_allow_html=True)
-        
-        with st.expander("📋 Copy Finglish"):
-            st.code(st.session_state.lyrics_finglish, language="text")
-    else:
-        st.info("Finglish transliteration will appear here.")
+    finglish_slot = st.container(key="finglish_output").empty()
+    if st.session_state.finglish_notices is not None:
+        apply_ui_calls(st.session_state.finglish_notices)
+        st.session_state.finglish_notices = None
+    pending_finglish_status()
+
+# Generation runs after the columns exist so both results can stream into them side by side
+if generate_requested:
+    with generate_status, st.spinner("Processing Lyrics (Diacritics & Finglish)..."):
+        # Generate both concurrently
+        processed, finglish = run_async(a_generate_both(raw_input, persian_slot, finglish_slot))
+        st.session_state.lyrics_processed = processed
+        st.session_state.lyrics_finglish = finglish
+
+# Hover a result to copy it (st.code's built-in copy button)
+if st.session_state.lyrics_processed:
+    render_result(persian_slot, st.session_state.lyrics_processed)
+else:
+    persian_slot.info("Persian result with diacritics will appear here.")
+
+if st.session_state.lyrics_finglish:
+    render_result(finglish_slot, st.session_state.lyrics_finglish)
+else:
+    finglish_slot.info("Finglish transliteration will appear here.")
 
 # --- Voice Correction Section ---
 st.markdown("---")
 st.subheader("🎙️ Native Speaker Correction")
 st.caption("Record your voice to correct a specific part of the lyrics. **Click once to start, and click again to stop.** The AI will only update the spoken part.")
 
-audio_value = st.audio_input("Record correction")
+@st.fragment
+def voice_correction_panel():
+    """Recording a clip only reruns this panel; the page reruns once a correction is applied."""
+    audio_value = st.audio_input("Record correction")
 
-if audio_value is not None:
-    if st.button("Apply Voice Correction", type="primary"):
-        if st.session_state.lyrics_processed:
-            with st.spinner("Listening to correction and updating specific segment..."):
-                # Get bytes from the UploadedFile object
-                audio_bytes = audio_value.read()
+    if audio_value is not None:
+        # Another correction would update the Finglish from before the pending one, so wait for it
+        pending = st.session_state.pending_finglish is not None
+        if st.button("Apply Voice Correction", type="primary", disabled=pending,
+                     help="Waiting for the background Finglish update to finish." if pending else None):
+            if st.session_state.lyrics_processed:
+                with st.spinner("Listening to correction and updating specific segment..."):
+                    # Get bytes from the UploadedFile object (no copy, unlike read()), WAV shrunk to Opus
+                    audio_bytes = audio_value.getvalue()
+                    audio_key = audio_digest(audio_bytes)
+                    audio = audio_part(*compress_audio(audio_key, audio_bytes, audio_value.type or "audio/wav"), audio_key)
                 
-                # 1. Update Persian Text (Partial Update Logic)
-                corrected_persian = process_voice_correction(st.session_state.lyrics_processed, audio_bytes)
-                st.session_state.lyrics_processed = corrected_persian
+                    # 1. Update Persian Text (Partial Update Logic)
+                    previous_persian = st.session_state.lyrics_processed
+                    corrected_persian = run_async(a_process_voice_correction(previous_persian, audio, audio_key))
                 
-                # 2. Auto-update Finglish to match new Persian
-                st.session_state.lyrics_finglish = generate_finglish(corrected_persian)
-                
-                st.success("Correction applied! Finglish has been updated as well.")
-                st.rerun()
-        else:
-            st.warning("Generate text first before applying corrections.")
+                    if corrected_persian == previous_persian:
+                        # Nothing changed (or the call failed): no need to pay for another Finglish round-trip
+                        st.info("The recording didn't change the text; Finglish left as is.")
+                    else:
+                        st.session_state.lyrics_processed = corrected_persian
+                    
+                        # 2. Auto-update Finglish to match new Persian (only the changed lines)
+                        update = a_update_finglish(
+                            previous_persian, corrected_persian, st.session_state.lyrics_finglish
+                        )
+                        if background_finglish:
+                            # Polled by pending_finglish_status; the page stays usable meanwhile
+                            future, calls = submit_async(update)
+                            st.session_state.pending_finglish = (future, calls, st.session_state.lyrics_processed)
+                        else:
+                            st.session_state.lyrics_finglish = run_async(update)
+                    
+                        st.success("Correction applied! Finglish has been updated as well.")
+                        # The results above live outside this fragment, so refresh the whole page
+                        st.rerun(scope="app")
+            else:
+                st.warning("Generate text first before applying corrections.")
+
+voice_correction_panel()
 
 # --- Footer ---
 st.markdown("---")